@@ -4,6 +4,7 @@ import sys
 import os
 import argparse
 import json
+import logging
 import glob
 import pandas as pd
 from natsort import natsorted
@@ -175,6 +176,8 @@ def main():
         json.dump(param_info, fp, indent=2)
 
     print('RUNNING:')
+    # show progress messages from niimasker
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     make_timeseries(**params)
 
 
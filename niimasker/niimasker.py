@@ -3,7 +3,10 @@ series data.
 """
 
 import os
-from itertools import repeat
+import logging
+import zipfile
+from collections import namedtuple
+from functools import lru_cache, partial
 import multiprocessing
 import numpy as np
 import pandas as pd
@@ -11,13 +14,30 @@ import nibabel as nib
 from nilearn.image import load_img
 from nilearn.input_data import NiftiMasker, NiftiLabelsMasker
 
+try:
+    from numba import njit, prange, set_num_threads
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """No-op stand-in for `numba.njit` when numba is not installed"""
+        return lambda func: func
+
+logger = logging.getLogger(__name__)
+
 
 def _discard_initial_scans(img, n_scans, regressors=None):
-    """Remove first number of scans from functional image and regressors"""
-    # crop scans from functional
-    arr = img.get_data()
-    arr = arr[:, :, :, n_scans:]
-    out_img = nib.Nifti1Image(arr, img.affine)
+    """Remove first number of scans from functional image and regressors.
+    Nothing is removed if `n_scans` is None or not positive"""
+    if n_scans is None or n_scans <= 0:
+        return img, regressors
+
+    # crop scans from functional; slicing the data proxy only reads the
+    # retained volumes rather than loading the full image first
+    arr = np.asarray(img.dataobj[..., n_scans:])
+    out_img = nib.Nifti1Image(arr, img.affine, img.header)
 
     if regressors is not None:
         # crop from regressors
@@ -30,37 +50,116 @@ def _discard_initial_scans(img, n_scans, regressors=None):
 
 ## CONFOUND REGRESSOR FUNCTIONS
 
+@njit(cache=True, fastmath=True)
+def _central_diff(x, t_r, out):
+    """Fill `out` with the temporal gradient of each column in `x`. Matches
+    `np.gradient(x, t_r, axis=0)`: one-sided differences at the endpoints and
+    central differences elsewhere"""
+    n_t, n_cols = x.shape
+    inv2 = 0.5 / t_r
+    for k in range(n_cols):
+        out[0, k] = (x[1, k] - x[0, k]) / t_r
+        out[n_t - 1, k] = (x[n_t - 1, k] - x[n_t - 2, k]) / t_r
+        for t in range(1, n_t - 1):
+            out[t, k] = (x[t + 1, k] - x[t - 1, k]) * inv2
+    return out
+
+
 def _compute_realign_derivs(regressors, t_r):
     """Compute derivatives from motion realignment parameters"""
-    cols = [i for i in regressors.columns if ('rot' in i) | ('trans' in i)]
-    realign = regressors[cols].values
+    cols = regressors.columns[regressors.columns.str.contains('rot|trans')]
+    realign = regressors[cols].to_numpy(dtype=np.float32)
     # compute central differences with sample distances = TR; (dx)
-    derivs = np.gradient(realign, t_r, axis=0)
+    if _HAS_NUMBA and realign.shape[0] > 1:
+        derivs = _central_diff(realign, float(t_r), np.empty_like(realign))
+    else:
+        derivs = np.gradient(realign, t_r, axis=0)
     deriv_cols = ['{}_d'.format(i) for i in cols]
-    return pd.concat([regressors, pd.DataFrame(derivs, columns=deriv_cols)],
-                     axis=1)
+
+    out = regressors.copy()
+    out[deriv_cols] = derivs
+    return out
 
 
 def _build_regressors(fname, regressor_names, realign_derivatives=False,
                       t_r=None):
     """Create regressors for masking"""
-    all_regressors = pd.read_csv(fname, sep=r'\t', engine='python')
-    regressors = all_regressors[regressor_names]
+    # a literal tab keeps pandas on the C parser, which can also skip unused
+    # columns; reindex afterwards because `usecols` keeps file order
+    regressors = pd.read_csv(fname, sep='\t', usecols=regressor_names)
+    if regressor_names is not None:
+        regressors = regressors[regressor_names]
     if realign_derivatives:
         if t_r is not None:
             regressors = _compute_realign_derivs(regressors, t_r)
         else:
             raise ValueError('t_r not provided for realignment derivatives.')
-    return regressors.values
+    # confounds carry far less precision than float32 offers; single precision
+    # halves the data moved during confound regression
+    return regressors.to_numpy(dtype=np.float32)
 
 
 ## MASKING FUNCTIONS
 
+def _unique_labels(arr):
+    """Sorted unique values of a mask/atlas array. Non-negative integer
+    atlases whose type `np.bincount` accepts are counted in a single pass
+    rather than sorting every voxel"""
+    arr = arr.ravel()
+    if (np.can_cast(arr.dtype, np.intp) and arr.size
+            and arr.min() >= 0 and arr.max() < arr.size):
+        return np.flatnonzero(np.bincount(arr)).astype(arr.dtype)
+    return np.unique(arr)
+
+
+@lru_cache(maxsize=8)
+def _cached_labels(fname, size, mtime_ns):
+    """Unique labels of a mask/atlas file. These are stored in a `.labels.npz`
+    sidecar next to the file along with the file's size and modification time
+    (in ns), and the sidecar is only reused when both match exactly"""
+    sidecar = fname + '.labels.npz'
+    try:
+        with np.load(sidecar) as cached:
+            if cached['size'] == size and cached['mtime_ns'] == mtime_ns:
+                return cached['labels']
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        # missing or unreadable sidecar; labels are recomputed below
+        pass
+
+    labels = _unique_labels(np.asarray(nib.load(fname).dataobj))
+    # write to a temporary file first so that a partially written sidecar is
+    # never read
+    tmp = '{}.{}.tmp'.format(sidecar, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, labels=labels, size=size, mtime_ns=mtime_ns)
+        os.replace(tmp, sidecar)
+    except OSError:
+        # e.g., read-only atlas directory or full disk; labels are just not
+        # persisted, and no temporary file is left behind
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+    return labels
+
+
+def _get_labels(mask_img):
+    """Sorted unique labels of a mask/atlas image, cached for images loaded
+    from a file"""
+    fname = mask_img.get_filename()
+    if fname is None or not os.path.exists(fname):
+        return _unique_labels(np.asarray(mask_img.dataobj))
+    stat = os.stat(fname)
+    return _cached_labels(os.path.abspath(fname), stat.st_size,
+                          stat.st_mtime_ns)
+
+
 def _set_masker(mask_img, **kwargs):
     """Check and see if multiple ROIs exist in atlas file"""
-    n_rois = np.unique(mask_img.get_data())
-    print('  {} region(s) detected from {}'.format(len(n_rois) - 1,
-                                                   mask_img.get_filename()))
+    n_rois = _get_labels(mask_img)
+    logger.info('  {} region(s) detected from {}'.format(
+        len(n_rois) - 1, mask_img.get_filename()))
 
     if len(n_rois) > 2:
         masker = NiftiLabelsMasker(mask_img, **kwargs)
@@ -72,30 +171,172 @@ def _set_masker(mask_img, **kwargs):
     return masker
 
 
-def _mask(masker, img, confounds=None, roi_labels=None, as_voxels=False):
-    """Extract timeseries from an image and apply post-processing"""
-    timeseries = masker.fit_transform(img, confounds=confounds)
+# masker parameters under which extraction reduces to selecting voxels from the
+# image; any other value requires nilearn's full processing
+_RAW_MASKER_PARAMS = {
+    'standardize': False,
+    'detrend': False,
+    'smoothing_fwhm': None,
+    'low_pass': None,
+    'high_pass': None,
+    'high_variance_confounds': False,
+    'target_affine': None,
+    'target_shape': None,
+    'background_label': 0,
+    'strategy': 'mean'
+}
+
+
+def _can_skip_masker(masker, mask_img, img, confounds=None):
+    """Check if timeseries can be extracted directly from the image data,
+    i.e. the mask is on the same grid as the image and no processing is
+    requested"""
+    params = masker.get_params()
+    if confounds is not None or len(img.shape) != 4:
+        return False
+    if any(params.get(k, v) != v for k, v in _RAW_MASKER_PARAMS.items()):
+        return False
+    # an additional mask restricts which atlas voxels are used
+    if (isinstance(masker, NiftiLabelsMasker) and
+            params.get('mask_img') is not None):
+        return False
+    return (mask_img.shape[:3] == img.shape[:3] and
+            np.allclose(mask_img.affine, img.affine))
+
+
+def _flatten(img):
+    """Flatten the spatial dimensions of an image, giving a (voxel x time)
+    matrix for 4D images and a vector for 3D images. Voxels are taken in the
+    column-major order that NIfTI data is stored in, so data loaded from disk
+    is reshaped without a copy"""
+    data = np.asarray(img.dataobj)
+    return data.reshape((-1,) + data.shape[3:], order='F')
+
+
+# flattened mask/atlas of a masker, indexed for direct extraction: the mask
+# image (for grid checks), region labels, in-region voxel indices, each
+# voxel's region index, and the voxel count of each region
+_Regions = namedtuple('_Regions',
+                      ['img', 'labels', 'voxels', 'regions', 'counts'])
+
+
+def _index_regions(atlas, labels=None):
+    """Index the regions of a flattened `atlas`, which are ordered by
+    ascending (non-zero) label value. Returns labels, in-region voxels, their
+    region indices and region voxel counts"""
+    if labels is None:
+        labels = _unique_labels(atlas)
+    labels = labels[labels != 0]
+    voxels = np.flatnonzero(atlas)
+    regions = np.searchsorted(labels, atlas[voxels])
+    counts = np.bincount(regions, minlength=labels.size)
+    return labels, voxels, regions, counts
+
 
+def _prepare_regions(masker):
+    """Flatten and index the mask/atlas of a masker. This only depends on the
+    masker, so it is done once rather than for every image. A binary mask is
+    a single region"""
     if isinstance(masker, NiftiMasker):
-        if as_voxels:
-            labels = ['voxel{}'.format(i)
-                      for i in np.arange(timeseries.shape[1])]
+        mask_img = load_img(masker.mask_img)
+    else:
+        mask_img = load_img(masker.labels_img)
+    return _Regions(mask_img, *_index_regions(_flatten(mask_img),
+                                              _get_labels(mask_img)))
+
+
+@njit(parallel=True, cache=True)
+def _roi_means(data, voxels, regions, counts, out):
+    """Fill `out` (time x region) with region means of the (voxel x time)
+    `data`, where `regions` gives the region index of each voxel in
+    `voxels`. Timepoints are processed in parallel; each voxel column is
+    contiguous for data flattened by `_flatten`"""
+    n_t = data.shape[1]
+    for t in prange(n_t):
+        for i in range(voxels.size):
+            out[t, regions[i]] += data[voxels[i], t]
+        for r in range(counts.size):
+            out[t, r] /= counts[r]
+    return out
+
+
+def _labels_mean(data, regions):
+    """Mean timeseries of each of the indexed `regions` (see `_Regions`) from
+    the (voxel x time) `data`. With numba, timepoints are averaged in
+    parallel; otherwise region sums are taken one timepoint at a time with
+    `np.bincount` over the in-region voxels only"""
+    n_regions = regions.counts.size
+    if _HAS_NUMBA:
+        means = _roi_means(data, regions.voxels, regions.regions,
+                           regions.counts,
+                           np.zeros((data.shape[1], n_regions)))
+        return means.astype(np.float32)
+
+    # each timepoint is a contiguous column of `data` as flattened by
+    # `_flatten`, and only its in-region voxels are copied
+    means = np.empty((data.shape[1], n_regions))
+    for t in range(data.shape[1]):
+        means[t] = np.bincount(regions.regions,
+                               weights=data[regions.voxels, t],
+                               minlength=n_regions)
+    means /= regions.counts
+    return means.astype(np.float32)
+
+
+def _is_fitted(masker):
+    """Check if a nilearn masker has already been fit"""
+    return hasattr(masker, 'mask_img_') or hasattr(masker, 'labels_img_')
+
+
+def _extract(masker, img, confounds=None):
+    """Extract timeseries with the masker, which is fit on first use only"""
+    if not _is_fitted(masker):
+        masker.fit()
+    timeseries = masker.transform(img, confounds=confounds)
+    # single precision is ample for extracted signals and halves the memory
+    # traffic of any further reductions
+    return timeseries.astype(np.float32, copy=False)
+
+
+def _mask(masker, img, confounds=None, roi_labels=None, as_voxels=False,
+          regions=None):
+    """Extract timeseries from an image and apply post-processing. `regions`
+    are the masker's indexed regions from `_prepare_regions`, which are
+    computed here if not provided"""
+    if isinstance(masker, NiftiMasker) and as_voxels:
+        timeseries = _extract(masker, img, confounds)
+        labels = ['voxel{}'.format(i) for i in range(timeseries.shape[1])]
+    else:
+        if regions is None:
+            regions = _prepare_regions(masker)
+        direct = _can_skip_masker(masker, regions.img, img, confounds)
+        if direct:
+            timeseries = _labels_mean(_flatten(img), regions)
         else:
-            timeseries = np.mean(timeseries, axis=1)
+            timeseries = _extract(masker, img, confounds)
+
+        if isinstance(masker, NiftiMasker):
+            if not direct:
+                timeseries = timeseries.mean(axis=1, dtype=np.float32)
             labels = ['roi'] if roi_labels is None else roi_labels
-    else:
-        labels = masker.labels_ if roi_labels is None else roi_labels
+        else:
+            atlas_labels = regions.labels if direct else masker.labels_
+            labels = atlas_labels if roi_labels is None else roi_labels
 
-    return pd.DataFrame(timeseries, columns=[str(i) for i in labels])
+    # a 2D array is wrapped as a single block without copying; building from
+    # a dict of columns would copy (or fragment) it instead
+    return pd.DataFrame(timeseries, columns=list(map(str, labels)),
+                        copy=False)
 
 
 def _mask_and_save(masker, img_name, output_dir, regressor_file=None,
                    regressor_names=None, realign_derivs=False, t_r=None,
-                   as_voxels=False, labels=None, discard_scans=None):
+                   as_voxels=False, labels=None, discard_scans=None,
+                   regions=None):
     """Runs the full masking process and saves output for a single image;
-    the main function used by `make_timeseries` `make_timeseries`"""
+    the main function used by `make_timeseries`. Returns the output file
+    name"""
     basename = os.path.basename(img_name)
-    print('  Extracting from {}'.format(basename))
     img = nib.load(img_name)
 
     if regressor_file is not None:
@@ -104,16 +345,48 @@ def _mask_and_save(masker, img_name, output_dir, regressor_file=None,
     else:
         confounds = None
 
-    if discard_scans is not None:
-        if discard_scans > 0:
-            img, confounds = _discard_initial_scans(img, discard_scans,
-                                                    confounds)
+    # `img` stays proxy-backed unless scans are cropped, so the masker reads
+    # the data directly from disk
+    img, confounds = _discard_initial_scans(img, discard_scans, confounds)
+
+    data = _mask(masker, img, confounds, labels, as_voxels, regions)
+
+    # write through a large buffer; without `float_format`, pandas formats
+    # floats in C using the shortest representation of each float32 value
+    out_fname = os.path.join(output_dir,
+                             basename.split('.')[0] + '_timeseries.tsv')
+    with open(out_fname, 'w', newline='', buffering=1 << 20) as f:
+        data.to_csv(f, sep='\t', index=False)
+    return out_fname
+
+
+## PARALLELIZATION FUNCTIONS
+
+# masker and its indexed regions held by each worker process; set once by
+# `_init_worker` so that the mask is not pickled and sent along with every task
+_MASKER = None
+_REGIONS = None
+
+
+def _init_worker(mask_img, masker_kwargs):
+    """Build and fit the masker, and index its regions, once per worker
+    process"""
+    global _MASKER, _REGIONS
+    _MASKER = _set_masker(load_img(mask_img), **masker_kwargs)
+    _MASKER.fit()
+    _REGIONS = _prepare_regions(_MASKER)
+    if _HAS_NUMBA:
+        # images are already processed in parallel; avoid oversubscribing
+        # the CPUs with threads inside each worker
+        set_num_threads(1)
 
-    data = _mask(masker, img, confounds, labels, as_voxels)
 
-    out_fname = basename.split('.')[0] + '_timeseries.tsv'
-    data.to_csv(os.path.join(output_dir, out_fname), sep='\t', index=False,
-                float_format='%.8f')
+def _mask_and_save_worker(files, **kwargs):
+    """Run `_mask_and_save` in a worker process using its own masker.
+    `files` is an (image, regressor file) pair"""
+    img_name, regressor_file = files
+    return _mask_and_save(_MASKER, img_name, regressor_file=regressor_file,
+                          regions=_REGIONS, **kwargs)
 
 
 def make_timeseries(input_files, mask_img, output_dir, labels=None,
@@ -130,7 +403,9 @@ def make_timeseries(input_files, mask_img, output_dir, labels=None,
     roi_file : niimg-like
         Image that contains region mask(s). Can either be a single binary mask
         for a single region, or a numerically labeled atlas file. 0 must
-        indicate background (non-region voxels).
+        indicate background (non-region voxels). If given as a file, its
+        labels are saved to a `.labels.npz` file alongside it (if writable)
+        for faster setup on later runs.
     output_dir : str
         Save directory.
     labels : str or list of str
@@ -161,8 +436,8 @@ def make_timeseries(input_files, mask_img, output_dir, labels=None,
     **masker_kwargs
         Keyword arguments for `nilearn.input_data` Masker objects.
     """
-    mask_img = load_img(mask_img)
-    masker = _set_masker(mask_img, **masker_kwargs)
+    # also validates the mask up front, before any workers are started
+    masker = _set_masker(load_img(mask_img), **masker_kwargs)
 
     # set as list of NoneType if no regressor files; makes it easy for
     # iterations
@@ -171,24 +446,40 @@ def make_timeseries(input_files, mask_img, output_dir, labels=None,
 
     # no parallelization
     if n_jobs == 1:
+        # fit and index regions once here rather than for every image;
+        # workers set up their own
+        masker.fit()
+        regions = _prepare_regions(masker)
         for i, img in enumerate(input_files):
-            _mask_and_save(masker, img, output_dir, regressor_files[i],
-                           regressor_names, realign_derivs, masker_kwargs['t_r'],
-                           as_voxels, labels, discard_scans)
+            out_fname = _mask_and_save(masker, img, output_dir,
+                                       regressor_files[i], regressor_names,
+                                       realign_derivs, masker_kwargs['t_r'],
+                                       as_voxels, labels, discard_scans,
+                                       regions)
+            logger.info('  Saved {}'.format(out_fname))
     else:
-        # repeat parameters are held constant for all parallelized iterations
-        args = zip(
-            repeat(masker),
-            input_files, # iterate over
-            repeat(output_dir),
-            regressor_files, # iterate over, paired with input_files
-            repeat(regressor_names),
-            repeat(realign_derivs),
-            repeat(masker_kwargs['t_r']),
-            repeat(as_voxels),
-            repeat(labels),
-            repeat(discard_scans)
-        )
-        with multiprocessing.Pool(processes=n_jobs) as pool:
-            pool.starmap(_mask_and_save, args)
+        # parameters held constant for all parallelized iterations; only the
+        # (image, regressor file) pairs are iterated over
+        func = partial(_mask_and_save_worker, output_dir=output_dir,
+                       regressor_names=regressor_names,
+                       realign_derivs=realign_derivs,
+                       t_r=masker_kwargs['t_r'], as_voxels=as_voxels,
+                       labels=labels, discard_scans=discard_scans)
+        files = list(zip(input_files, regressor_files))
+        # small chunks let idle workers pick up remaining images when run
+        # times vary across images
+        chunksize = max(1, len(files) // (n_jobs * 4))
 
+        # each worker builds its own masker from `mask_img` (ideally a file
+        # path) rather than receiving a pickled copy with every task. Spawned
+        # workers do not inherit the parent's memory, and are replaced after
+        # a few tasks to keep their memory use bounded over long runs
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=n_jobs, maxtasksperchild=4,
+                      initializer=_init_worker,
+                      initargs=(mask_img, masker_kwargs)) as pool:
+            # progress is only reported from the main process so that workers
+            # never write to the shared stdout
+            for out_fname in pool.imap_unordered(func, files,
+                                                 chunksize=chunksize):
+                logger.info('  Saved {}'.format(out_fname))
@@ -16,6 +16,9 @@ setup(
         'nilearn>=0.5.0',
         'natsort'
     ],
+    extras_require={
+        'numba': ['numba']
+    },
     tests_require=[
         'pytest',
         'pytest-cov'
@@ -69,9 +69,162 @@ def test_discard_initial_scans(atlas_data, regressors):
 
     n_scans = 3
     img, regs = niimasker._discard_initial_scans(atlas_data, n_scans, regressors)
-    assert img.get_data().shape[3] == atlas_data.get_data().shape[3] - n_scans
+    assert img.shape[3] == atlas_data.shape[3] - n_scans
     assert regs.shape[0] == regressors.shape[0] - n_scans
 
+    # nothing to discard (including negative counts) returns the inputs as
+    # they are
+    for n_scans in [0, None, -3]:
+        img, regs = niimasker._discard_initial_scans(atlas_data, n_scans,
+                                                     regressors)
+        assert img is atlas_data
+        assert regs is regressors
+
+
+def test_mask_and_save_negative_discard(atlas_data, regressors, tmpdir):
+    """Check that a negative number of scans to discard keeps every scan"""
+    img_name = os.path.join(str(tmpdir), 'func.nii.gz')
+    atlas_data.to_filename(img_name)
+    reg_name = os.path.join(str(tmpdir), 'regressors.tsv')
+    regressors.to_csv(reg_name, sep='\t', index=False)
+
+    masker = niimasker._set_masker(nib.load(_get_atlas()['maps']))
+    out_fname = niimasker._mask_and_save(masker, img_name, str(tmpdir),
+                                         regressor_file=reg_name,
+                                         regressor_names=['csf', 'wm'],
+                                         discard_scans=-3)
+    result = pd.read_csv(out_fname, sep='\t')
+    assert result.shape[0] == atlas_data.shape[3]
+
+
+def test_compute_realign_derivs(regressors):
+    """Check that derivatives are only computed for realignment parameters and
+    are appended after the original regressors"""
+    result = niimasker._compute_realign_derivs(regressors, t_r=2)
+
+    realign_cols = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+    expected_cols = (list(regressors.columns) +
+                     ['{}_d'.format(i) for i in realign_cols])
+    assert list(result.columns) == expected_cols
+
+    expected = np.gradient(regressors[realign_cols].values, 2, axis=0)
+    assert np.allclose(result.iloc[:, -6:].values, expected, atol=1e-6)
+    # input is left untouched
+    assert regressors.shape[1] == 8
+
+
+@pytest.mark.skipif(not niimasker._HAS_NUMBA, reason='numba not installed')
+@pytest.mark.parametrize('n_t', [2, 3, 50])
+def test_central_diff(n_t):
+    """Check that the numba kernel matches np.gradient, including the
+    shortest (2-row) input"""
+    np.random.seed(42)
+    x = np.random.rand(n_t, 6)
+    result = niimasker._central_diff(x, 2., np.empty_like(x))
+    assert np.allclose(result, np.gradient(x, 2., axis=0))
+
+
+def test_build_regressors(regressors, tmpdir):
+    """Check that only the requested regressors are read, in the requested
+    order"""
+    fname = os.path.join(str(tmpdir), 'regressors.tsv')
+    regressors.to_csv(fname, sep='\t', index=False)
+
+    names = ['rot_x', 'csf', 'trans_y']
+    result = niimasker._build_regressors(fname, names)
+    assert result.dtype == np.float32
+    assert np.allclose(result, regressors[names].values)
+
+    result = niimasker._build_regressors(fname, names, realign_derivatives=True,
+                                         t_r=2)
+    assert result.shape == (50, 5)
+
+    with pytest.raises(ValueError):
+        niimasker._build_regressors(fname, names, realign_derivatives=True)
+
+
+def test_unique_labels():
+    """Check that integer and float arrays give the same sorted labels"""
+    arr = np.array([[0, 5, 5], [2, 0, 9]], dtype=np.int16)
+    assert np.array_equal(niimasker._unique_labels(arr), [0, 2, 5, 9])
+    assert np.array_equal(niimasker._unique_labels(arr.astype(float)),
+                          [0, 2, 5, 9])
+    # negative labels and unsigned types too wide for bincount fall back to
+    # sorting
+    assert np.array_equal(niimasker._unique_labels(-arr), [-9, -5, -2, 0])
+    assert np.array_equal(niimasker._unique_labels(arr.astype(np.uint64)),
+                          [0, 2, 5, 9])
+
+
+def test_flatten(atlas_data):
+    """Check that images and masks are flattened to matching voxel orders"""
+    flat = niimasker._flatten(atlas_data)
+    assert flat.shape == (np.prod(atlas_data.shape[:3]), atlas_data.shape[3])
+
+    atlas = niimasker._flatten(nib.load(_get_atlas()['maps']))
+    assert atlas.ndim == 1
+    # every volume of atlas_data is the atlas itself
+    assert np.array_equal(flat[:, 0], atlas)
+
+
+@pytest.mark.parametrize('use_numba', [True, False])
+@pytest.mark.parametrize('dtype,order', [(np.float64, 'C'),
+                                         (np.float32, 'F'),
+                                         (np.int16, 'F')])
+def test_labels_mean(use_numba, dtype, order, monkeypatch):
+    """Check region means against a direct computation, including labels that
+    are not contiguous, for both the numba and bincount implementations and
+    for data laid out as `_flatten` returns it"""
+    if use_numba and not niimasker._HAS_NUMBA:
+        pytest.skip('numba not installed')
+    monkeypatch.setattr(niimasker, '_HAS_NUMBA', use_numba)
+
+    np.random.seed(42)
+    atlas = np.array([0, 3, 3, 7, 0, 7, 7, 1])
+    data = np.asarray(np.random.rand(atlas.size, 5) * 100, dtype=dtype,
+                      order=order)
+
+    regions = niimasker._Regions(None, *niimasker._index_regions(atlas))
+    labels = regions.labels
+    assert np.array_equal(labels, [1, 3, 7])
+    result = niimasker._labels_mean(data, regions)
+    expected = np.column_stack([data[atlas == i].mean(axis=0, dtype=np.float64)
+                                for i in labels])
+    assert result.dtype == np.float32
+    assert np.allclose(result, expected)
+
+
+def test_get_labels(tmpdir):
+    """Check that labels of atlas files are persisted and reused"""
+    atlas_img = nib.load(_get_atlas()['maps'])
+    expected = np.unique(atlas_img.get_fdata())
+
+    # in-memory images are not cached
+    mem_img = nib.Nifti1Image(atlas_img.get_fdata(), atlas_img.affine)
+    assert np.array_equal(niimasker._get_labels(mem_img), expected)
+
+    fname = os.path.join(str(tmpdir), 'atlas.nii.gz')
+    atlas_img.to_filename(fname)
+    labels = niimasker._get_labels(nib.load(fname))
+    assert np.array_equal(labels, expected)
+    assert os.path.exists(fname + '.labels.npz')
+    assert np.array_equal(niimasker._get_labels(nib.load(fname)), expected)
+
+    # a corrupt sidecar is recomputed rather than raising
+    niimasker._cached_labels.cache_clear()
+    with open(fname + '.labels.npz', 'wb') as f:
+        f.write(b'PK\x03\x04 not a zip file')
+    assert np.array_equal(niimasker._get_labels(nib.load(fname)), expected)
+
+    # replacing the atlas with an older file (e.g., `cp -p`) must not reuse
+    # the sidecar
+    bin_img = nib.Nifti1Image(np.where(atlas_img.get_fdata() == 2001, 1., 0),
+                              atlas_img.affine)
+    bin_img.to_filename(fname)
+    old_ns = os.stat(fname + '.labels.npz').st_mtime_ns - 10 ** 9
+    os.utime(fname, ns=(old_ns, old_ns))
+    assert np.array_equal(niimasker._get_labels(nib.load(fname)), [0, 1])
+
 
 def test_set_masker(atlas_data):
     """Ensure that correct masker class is returned by _set_masker"""
@@ -84,7 +237,7 @@ def test_set_masker(atlas_data):
     assert isinstance(masker, NiftiLabelsMasker)
 
     # check single ROI atlas; create binary mask from atlas first
-    bin_img = nib.Nifti1Image(np.where(atlas_img.get_data() == 2001, 1., 0),
+    bin_img = nib.Nifti1Image(np.where(atlas_img.get_fdata() == 2001, 1., 0),
                               atlas_img.affine)
     masker = niimasker._set_masker(bin_img)
     assert isinstance(masker, NiftiMasker)
@@ -92,19 +245,27 @@ def test_set_masker(atlas_data):
 
 def test_mask(atlas_data, regressors, post_processed_data):
     """Test basic (completely raw) and post-processed masking. Ensure results
-    match equivalent versions created directly by nilearn"""
+    match equivalent versions created directly by nilearn, up to the single
+    precision that niimasker returns"""
 
     atlas = _get_atlas()
     atlas_img = nib.load(atlas['maps'])
 
-    # test basic mask with no post-processing
+    # test basic mask with no post-processing; computed without nilearn
     test_masker = niimasker._set_masker(atlas_img)
+    assert niimasker._can_skip_masker(test_masker, atlas_img, atlas_data)
     result = niimasker._mask(test_masker, atlas_data)
 
     expected_masker = NiftiLabelsMasker(atlas_img)
     expected = expected_masker.fit_transform(atlas_data)
 
-    assert np.array_equal(result, expected)
+    assert np.allclose(result, expected)
+
+    # regions indexed once up front give the same result
+    regions = niimasker._prepare_regions(test_masker)
+    assert np.array_equal(regions.labels, np.unique(atlas_img.get_fdata())[1:])
+    result = niimasker._mask(test_masker, atlas_data, regions=regions)
+    assert np.allclose(result, expected)
 
     # test mask with all post-processing options
     test_masker = niimasker._set_masker(atlas_img, standardize=True,
@@ -112,15 +273,59 @@ def test_mask(atlas_data, regressors, post_processed_data):
                                         low_pass=.1, high_pass=.01, t_r=2)
     result = niimasker._mask(test_masker, atlas_data, confounds=regressors.values)
 
-    assert np.array_equal(result, post_processed_data)
-
-
-
-
-
-
-
+    assert np.allclose(result, post_processed_data)
 
 
+def test_mask_binary(atlas_data, regressors):
+    """Check that the direct mean of a binary mask on the same grid as the
+    image matches nilearn, with and without post-processing"""
+    atlas_img = nib.load(_get_atlas()['maps'])
+    bin_img = nib.Nifti1Image(np.where(atlas_img.get_fdata() == 2001, 1., 0),
+                              atlas_img.affine)
 
+    test_masker = niimasker._set_masker(bin_img)
+    assert niimasker._can_skip_masker(test_masker, bin_img, atlas_data)
+    result = niimasker._mask(test_masker, atlas_data)
 
+    expected = NiftiMasker(bin_img).fit_transform(atlas_data).mean(axis=1)
+    assert np.allclose(result['roi'], expected)
+    assert np.allclose(result['roi'], 2001)
+
+    # confounds require the full nilearn processing
+    assert not niimasker._can_skip_masker(test_masker, bin_img, atlas_data,
+                                          confounds=regressors.values)
+
+
+def test_make_timeseries_parallel(atlas_data, regressors, tmpdir):
+    """Check that serial and parallel extraction write identical outputs"""
+    atlas_file = _get_atlas()['maps']
+    data = atlas_data.get_fdata(dtype=np.float32)[..., :10]
+
+    input_files, regressor_files = [], []
+    for i in range(3):
+        img_name = os.path.join(str(tmpdir), 'func{}.nii.gz'.format(i))
+        nib.Nifti1Image(data * (i + 1), atlas_data.affine).to_filename(
+            img_name)
+        input_files.append(img_name)
+
+        reg_name = os.path.join(str(tmpdir), 'regressors{}.tsv'.format(i))
+        regressors.iloc[:10].to_csv(reg_name, sep='\t', index=False)
+        regressor_files.append(reg_name)
+
+    outputs = {}
+    for n_jobs in [1, 2]:
+        output_dir = os.path.join(str(tmpdir), 'out{}'.format(n_jobs))
+        os.makedirs(output_dir)
+        niimasker.make_timeseries(input_files, atlas_file, output_dir,
+                                  regressor_files=regressor_files,
+                                  regressor_names=['csf', 'wm'],
+                                  discard_scans=2, n_jobs=n_jobs, t_r=2)
+        outputs[n_jobs] = output_dir
+
+    for i in range(3):
+        out_fname = 'func{}_timeseries.tsv'.format(i)
+        serial = pd.read_csv(os.path.join(outputs[1], out_fname), sep='\t')
+        parallel = pd.read_csv(os.path.join(outputs[2], out_fname), sep='\t')
+        assert serial.shape[0] == 8
+        assert list(serial.columns) == list(parallel.columns)
+        pd.testing.assert_frame_equal(serial, parallel)